@@ -1,16 +1,34 @@
 import os
 import cv2
-import base64
+import time
+import queue
+import numpy as np
 from threading import Lock
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 
 from flask import Flask, request, jsonify
 from flask_socketio import SocketIO
 from flask_cors import CORS
-from ultralytics import YOLO
 from werkzeug.utils import secure_filename
 
+from detector import (
+    BATCH_SIZE,
+    IMG_SIZE,
+    DetectorProcess,
+    load_model,
+    results_to_dets,
+    track_batch,
+)
+
+try:
+    from numba import njit
+except ImportError:   # numba is optional — plain Python still works
+    def njit(*args, **kwargs):
+        def wrap(func):
+            return func
+        return wrap
+
 # -------------------------------------------------
 # App & Socket.IO setup
 # -------------------------------------------------
@@ -34,8 +52,62 @@ socketio = SocketIO(
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-MODEL_PATH = "yolov8n.pt"
-model = YOLO(MODEL_PATH)
+# Run YOLO on every Kth frame only; in-between frames advance the last
+# boxes by per-track velocity. At ~30 fps traffic footage objects move a
+# few px/frame, so 2-3 is nearly free accuracy-wise.
+DETECT_STRIDE = int(os.environ.get("DETECT_STRIDE", "1"))
+
+# Client-facing frame rate. Tracking still runs on every frame so the
+# counts stay exact; frames above this rate just skip annotate+emit.
+TARGET_FPS = float(os.environ.get("TARGET_FPS", "15"))
+EMIT_INTERVAL = 1.0 / TARGET_FPS
+
+# The stream is a live preview, not a recording — quality 70 is plenty
+# and much cheaper to encode/ship than OpenCV's default 95
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "70"))
+JPEG_PARAMS = [
+    cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY,
+    cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+    cv2.IMWRITE_JPEG_PROGRESSIVE, 0
+]
+
+# Run the YOLO engine in a dedicated subprocess instead of in-process.
+# With multiple web workers this keeps a single copy of the weights on
+# the GPU (each app instance talks to its own detector; point workers at
+# a shared broker if you scale past one instance).
+DETACHED_DETECTOR = os.environ.get("DETACHED_DETECTOR") == "1"
+
+# The subprocess is spawned lazily by the worker, never at import: the
+# spawn context re-imports this module in the child, and a module-level
+# Process.start() would re-run during that bootstrap and crash it.
+detector = None
+model = None if DETACHED_DETECTOR else load_model()
+
+# Route FFmpeg decode through NVDEC so H.264 decompression happens on the
+# GPU instead of the CPU. Opt-in: forcing h264_cuvid on a host without
+# NVDEC makes the capture fail to open.
+if os.environ.get("USE_NVDEC") == "1":
+    os.environ.setdefault(
+        "OPENCV_FFMPEG_CAPTURE_OPTIONS",
+        "video_codec;h264_cuvid|hwaccel;cuda|hwaccel_output_format;cuda"
+    )
+
+
+def open_capture(src):
+    """Open a video source with the FFmpeg backend and let OpenCV pick
+    whatever hardware decoder the host offers (NVDEC, VAAPI, ...)."""
+    cap = cv2.VideoCapture(
+        src,
+        cv2.CAP_FFMPEG,
+        [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    )
+    # A few frames of read-ahead smooths out decoder jitter
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 3)
+    return cap
+
+# Transparent OpenCL offload for the drawing + JPEG encode path: cv2
+# dispatches work on cv2.UMat to the GPU/iGPU when the host has one
+USE_OPENCL = os.environ.get("USE_OPENCL", "1") == "1" and cv2.ocl.haveOpenCL()
 
 # COCO class indices → names
 TARGET_CLASSES = {
@@ -47,18 +119,52 @@ TARGET_CLASSES = {
     7: "Truck"
 }
 
+# Constant id arrays for the vectorized np.isin tests — built once,
+# not per frame
+TARGET_CLS_ARR = np.array(sorted(TARGET_CLASSES), dtype=np.int32)
+VEHICLE_CLS = np.array([2, 3, 5, 7], dtype=np.int32)  # Car/Motorcycle/Bus/Truck
+
+# Dense class index (0..5) per COCO id, for array-based counters
+CLASS_NAMES = [TARGET_CLASSES[c] for c in sorted(TARGET_CLASSES)]
+CLS_TO_IDX = np.full(80, -1, dtype=np.int32)
+for _i, _c in enumerate(sorted(TARGET_CLASSES)):
+    CLS_TO_IDX[_c] = _i
+
+# ByteTrack ids grow monotonically; a flat uint8 mask this size is still
+# only ~1 MB and lets the Numba kernel test/set "already counted" in O(1)
+MAX_TRACK_ID = 1_000_000
+
 # -------------------------------------------------
-# Shared state (protected by lock)
+# Shared state
 # -------------------------------------------------
-current_video_source = "traffic_video.mp4"
-video_needs_reset = False
-
-track_history = defaultdict(list)
-cumulative_counts = {name: 0 for name in TARGET_CLASSES.values()}
-counted_ids = set()
+DEFAULT_SOURCE = "traffic_video.mp4"
 
+# Upload handler -> reader handoff: the only cross-thread state. The
+# reader swaps the capture and the worker resets its counters, so the
+# tracking state below is touched by the worker thread alone and the
+# per-frame hot path needs no lock at all.
+pending_source = None
 state_lock = Lock()
 
+# Only the previous centre-y per track is needed for the crossing test,
+# so store one float per track instead of a 30-point trail
+last_y = {}
+counted_mask = np.zeros(MAX_TRACK_ID, dtype=np.uint8)   # 1 = already counted
+class_counts = np.zeros(len(CLASS_NAMES), dtype=np.int64)
+total_counted = np.zeros(1, dtype=np.int64)   # running total for the alert logic
+
+# The alert total has always excluded motorcycles (matches the frontend sum)
+COUNT_IN_TOTAL = np.array(
+    [name != "Motorcycle" for name in CLASS_NAMES], dtype=np.int64
+)
+
+# Alert thresholds: (upper bound, level, colour, message)
+STATUSES = [
+    (10, "LOW", "green", "Smooth Traffic Flow"),
+    (20, "MEDIUM", "orange", "Moderate Traffic Volume"),
+    (float("inf"), "HIGH", "red", "🚨 Heavy Traffic Volume"),
+]
+
 # Background task control
 video_task_started = False
 task_lock = Lock()
@@ -73,8 +179,7 @@ def index():
 # -------------------------------------------------
 @app.route("/upload", methods=["POST"])
 def upload_video():
-    global current_video_source, video_needs_reset
-    global cumulative_counts, counted_ids, track_history
+    global pending_source
 
     if "video" not in request.files:
         return jsonify({"error": "No file uploaded"}), 400
@@ -88,104 +193,343 @@ def upload_video():
     file.save(filepath)
 
     with state_lock:
-        current_video_source = filepath
-        video_needs_reset = True
-        cumulative_counts = {name: 0 for name in TARGET_CLASSES.values()}
-        counted_ids = set()
-        track_history = defaultdict(list)
+        pending_source = filepath
 
     print(f"[INFO] Switched to new video: {filepath}")
     return jsonify({"message": "Upload successful"}), 200
 
 # -------------------------------------------------
-# Video processing loop (runs ONCE)
+# Video pipeline: reader -> worker -> writer
 # -------------------------------------------------
-def process_video():
-    global model,video_needs_reset
+# Three stages connected by small bounded queues so decode, YOLO
+# inference and JPEG-encode/emit overlap instead of running serially.
+# All tracking/counting state stays in the single worker stage.
+read_q = queue.Queue(maxsize=4)    # reader -> worker: (frame, line geometry)
+write_q = queue.Queue(maxsize=4)   # worker -> writer: (frame, counts, status)
 
-    cap = cv2.VideoCapture(current_video_source)
+
+def line_geometry(cap):
+    """Counting-line constants for a capture: y plus both endpoints,
+    computed once per open instead of per frame/draw call."""
     line_y = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) // 1.5)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    return line_y, (0, line_y), (width, line_y)
+
+
+def read_frames():
+    """Stage 1: decode frames and feed the worker (None = video reset)."""
+    global pending_source
+
+    src_path = DEFAULT_SOURCE
+    cap = open_capture(src_path)
+    geom = line_geometry(cap)
 
     while True:
-        # Handle video reset safely
-        with state_lock:
-            if video_needs_reset:
-                cap.release()
-                cap = cv2.VideoCapture(current_video_source)
-                line_y = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) // 1.5)
-                video_needs_reset = False
+        reset_src = None
+        if pending_source is not None:   # cheap unlocked peek
+            with state_lock:
+                reset_src = pending_source
+                pending_source = None
+
+        if reset_src is not None:
+            cap.release()
+            src_path = reset_src
+            cap = open_capture(src_path)
+            geom = line_geometry(cap)
+            read_q.put(None)   # tell the worker to drop its batch
 
         success, frame = cap.read()
         if not success:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            # End of file: re-open instead of seeking to frame 0 — a
+            # POS_FRAMES seek forces a full index scan on some backends
+            cap.release()
+            cap = open_capture(src_path)
             continue
 
-        # YOLOv8 tracking
-        results = model.track(
-            frame,
-            persist=True,
-            tracker="bytetrack.yaml",
-            verbose=False
-        )
+        read_q.put((frame, geom))
+
+
+# cv2.imencode releases the GIL, so two pool threads encode in parallel
+# and the writer never blocks the Socket.IO event loop on a C call
+encode_pool = ThreadPoolExecutor(max_workers=2)
+
+
+def emit_frames():
+    """Stage 3: JPEG-encode annotated frames and push them to clients.
+
+    Encoding runs on the pool, pipelined one frame ahead: while frame N
+    is emitted, frame N+1 is already being compressed.
+    """
+    pending = None   # (encode future, counts, status)
+
+    while True:
+        frame, counts, status = write_q.get()
+        fut = encode_pool.submit(cv2.imencode, ".jpg", frame, JPEG_PARAMS)
+
+        if pending is not None:
+            emit_encoded(*pending)
+        pending = (fut, counts, status)
+
+
+def emit_encoded(fut, counts, status):
+    _, buffer = fut.result()
+
+    # Raw bytes go out as a binary engine.io attachment — no base64
+    # inflation (4/3x payload) and no encode step per frame
+    socketio.emit(
+        "video_data",
+        {
+            "image": bytes(buffer),
+            "counts": counts,
+            "status": status
+        }
+    )
+
+
+def process_video():
+    """Stage 2: batched YOLO tracking + counting (runs ONCE)."""
+    global model, detector
+
+    if DETACHED_DETECTOR and detector is None:
+        detector = DetectorProcess()
+
+    socketio.start_background_task(read_frames)
+    socketio.start_background_task(emit_frames)
+
+    frame_batch = []
+    infer_batch = []
+    scale_batch = []
+    geom = None
+    frame_no = 0
+
+    while True:
+        item = read_q.get()
+        if item is None:
+            # Video was swapped out — discard the half-filled batch and
+            # start counting from scratch
+            frame_batch = []
+            infer_batch = []
+            scale_batch = []
+            counted_mask[:] = 0
+            class_counts[:] = 0
+            total_counted[:] = 0
+            last_y.clear()
+            _last_dets[0] = None
+            _extrap_boxes[0] = None
+            _track_vel.clear()
+            _last_det_frame[0] = 0
+            frame_no = 0
+            continue
+
+        # Accumulate frames and run YOLO once per batch — one batched
+        # .track() call is much cheaper than BATCH_SIZE single-frame calls.
+        # Inference sees a downscaled copy; drawing/emit keep the hi-res frame.
+        frame, geom = item
+        h, w = frame.shape[:2]
+        scale = min(1.0, IMG_SIZE / max(h, w))
+        if scale < 1.0:
+            small = cv2.resize(
+                frame,
+                (round(w * scale), round(h * scale)),
+                interpolation=cv2.INTER_LINEAR
+            )
+        else:
+            small = frame
+
+        frame_batch.append(frame)
+        infer_batch.append(small)
+        scale_batch.append(scale)
+        if len(frame_batch) < BATCH_SIZE:
+            continue
+
+        # YOLOv8 tracking (batched). With DETECT_STRIDE > 1 only every
+        # Kth frame of the batch goes through the model; the rest reuse
+        # the last boxes advanced by per-track velocity.
+        det_inputs = infer_batch[::DETECT_STRIDE]
+        det_scales = scale_batch[::DETECT_STRIDE]
+        if DETACHED_DETECTOR:
+            dets_list = detector.track(det_inputs, det_scales)
+        else:
+            dets_list = [
+                results_to_dets(r, s)
+                for r, s in zip(track_batch(model, det_inputs), det_scales)
+            ]
+
+        dets_iter = iter(dets_list)
+        for i, frame in enumerate(frame_batch):
+            frame_no += 1
+            if i % DETECT_STRIDE == 0:
+                dets = next(dets_iter)
+                note_detection(dets, frame_no)
+            else:
+                dets = extrapolate_dets()
+            process_frame(frame, dets, geom)
+
+        frame_batch = []
+        infer_batch = []
+        scale_batch = []
+
+
+# Interpolation state for DETECT_STRIDE > 1 (worker thread only):
+# the boxes/ids/classes of the last YOLO frame, the frame number it was
+# seen on, each track's per-frame centre velocity, and a separate working
+# copy of the boxes that the skipped frames advance — _last_dets itself
+# must stay untouched so velocities compare real detections only
+_last_dets = [None]
+_extrap_boxes = [None]
+_last_det_frame = [0]
+_track_vel = {}
+
+
+def note_detection(dets, frame_no):
+    """Record the latest real detections and refresh track velocities."""
+    # Velocity uses the real frame gap, not DETECT_STRIDE: the stride
+    # slice restarts per batch, so gaps vary when it doesn't divide
+    # BATCH_SIZE evenly
+    gap = frame_no - _last_det_frame[0]
+    _last_det_frame[0] = frame_no
+
+    if dets is None:
+        _last_dets[0] = None
+        _extrap_boxes[0] = None
+        return
+
+    boxes, track_ids, clss = dets
+    prev = _last_dets[0]
+    if prev is not None and gap > 0:
+        pb, pi, _ = prev
+        prev_pos = {t: (pb[j, 0], pb[j, 1]) for j, t in enumerate(pi.tolist())}
+        for j, t in enumerate(track_ids.tolist()):
+            p = prev_pos.get(t)
+            if p is not None:
+                _track_vel[t] = (
+                    (boxes[j, 0] - p[0]) / gap,
+                    (boxes[j, 1] - p[1]) / gap
+                )
+
+    _last_dets[0] = (boxes.copy(), track_ids, clss)
+    _extrap_boxes[0] = boxes.copy()
+
+    # Drop velocities for tracks gone from this detection frame, mirroring
+    # the last_y pruning — otherwise the dict grows for the stream's lifetime
+    live = set(track_ids.tolist())
+    for t in list(_track_vel):
+        if t not in live:
+            del _track_vel[t]
+
+
+def extrapolate_dets():
+    """Advance the working copy of the last boxes one frame along each
+    track's velocity."""
+    if _last_dets[0] is None:
+        return None
+
+    _, track_ids, clss = _last_dets[0]
+    boxes = _extrap_boxes[0]
+    for j, t in enumerate(track_ids.tolist()):
+        vx, vy = _track_vel.get(t, (0.0, 0.0))
+        boxes[j, 0] += vx
+        boxes[j, 1] += vy
+    return boxes, track_ids, clss
+
+
+@njit(cache=True)
+def update_counts(ids, cys, prev_ys, line_y, counted_mask, class_counts,
+                  cls_idx, include_in_total, total):
+    """Crossing detection + per-class counting, compiled by Numba.
+
+    Marks each track that crossed the line downward in counted_mask,
+    bumps its class counter and the running alert total; returns True if
+    anything new was counted.
+    """
+    new_count = False
+    for i in range(ids.shape[0]):
+        py = prev_ys[i]
+        if np.isnan(py) or py >= line_y or cys[i] < line_y:
+            continue
+        tid = ids[i]
+        if 0 <= tid < counted_mask.shape[0] and counted_mask[tid] == 0:
+            counted_mask[tid] = 1
+            class_counts[cls_idx[i]] += 1
+            total[0] += include_in_total[cls_idx[i]]
+            new_count = True
+    return new_count
+
+
+_last_emit = 0.0
+
+
+def process_frame(frame, dets, geom):
+    global last_y, _last_emit
+
+    line_y, line_p1, line_p2 = geom
+
+    # Cap the preview at TARGET_FPS by dropping frames: annotation and
+    # encode are skipped entirely, only the counting below still runs
+    now = time.monotonic()
+    emitting = now - _last_emit >= EMIT_INTERVAL
+
+    canvas = None
+    if emitting:
+        # All annotation goes through `canvas` — a UMat when OpenCL is
+        # available, so draws and the later imencode run on the GPU
+        canvas = cv2.UMat(frame) if USE_OPENCL else frame
 
         # Draw counting line
-        cv2.line(
-            frame,
-            (0, line_y),
-            (frame.shape[1], line_y),
-            (0, 0, 255),
-            2
-        )
-        current_density=0
-        active_ids = set()
+        cv2.line(canvas, line_p1, line_p2, (0, 0, 255), 2)
+    current_density=0
+    active_ids = set()
+
+    if dets is not None:
+        boxes, track_ids, clss = dets
+
+        current_density = int(np.isin(clss, VEHICLE_CLS).sum())
 
-        if results and results[0].boxes.id is not None:
-            boxes = results[0].boxes.xywh.cpu()
-            track_ids = results[0].boxes.id.int().cpu().tolist()
-            clss = results[0].boxes.cls.int().cpu().tolist()
-            current_density = sum(1 for c in clss if c in [2,3,5,7])
-            for box, track_id, cls in zip(boxes, track_ids, clss):
-                if cls not in TARGET_CLASSES:
-                    continue
+        # One vectorized mask instead of a per-box membership test
+        keep = np.isin(clss, TARGET_CLS_ARR)
+        boxes = boxes[keep]
+        track_ids = track_ids[keep]
+        clss = clss[keep]
 
-                active_ids.add(track_id)
-                class_name = TARGET_CLASSES[cls]
+        cys = boxes[:, 1]
+        active_ids = set(track_ids.tolist())
 
+        # Previous centre-y per track (NaN = first sighting, so the
+        # comparison below can never count it)
+        prev_ys = np.array(
+            [last_y.get(t, np.nan) for t in track_ids.tolist()]
+        )
+        last_y.update(zip(track_ids.tolist(), cys.tolist()))
+
+        # Downward crossings + per-class counting in one compiled pass
+        new_count = update_counts(
+            track_ids.astype(np.int64),
+            cys.astype(np.float64),
+            prev_ys,
+            float(line_y),
+            counted_mask,
+            class_counts,
+            CLS_TO_IDX[clss],
+            COUNT_IN_TOTAL,
+            total_counted
+        )
+
+        if new_count and emitting:
+            cv2.line(canvas, line_p1, line_p2, (0, 255, 0), 4)
+
+        # Draw bounding boxes
+        if emitting:
+            for box, track_id, cls in zip(boxes, track_ids.tolist(), clss.tolist()):
                 x, y, w, h = box
-                cx, cy = float(x), float(y)
-
-                with state_lock:
-                    track = track_history[track_id]
-                    track.append((cx, cy))
-                    if len(track) > 30:
-                        track.pop(0)
-
-                    if len(track) > 1:
-                        prev_y = track[-2][1]
-                        curr_y = track[-1][1]
-
-                        # Count downward crossing only
-                        if prev_y < line_y <= curr_y:
-                            if track_id not in counted_ids:
-                                cumulative_counts[class_name] += 1
-                                counted_ids.add(track_id)
-                                cv2.line(
-                                    frame,
-                                    (0, line_y),
-                                    (frame.shape[1], line_y),
-                                    (0, 255, 0),
-                                    4
-                                )
-
-                # Draw bounding box
                 x1, y1 = int(x - w / 2), int(y - h / 2)
                 x2, y2 = int(x + w / 2), int(y + h / 2)
-                color = (0, 255, 255) if track_id in counted_ids else (255, 0, 0)
+                counted = track_id < MAX_TRACK_ID and counted_mask[track_id]
+                color = (0, 255, 255) if counted else (255, 0, 0)
 
-                cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+                cv2.rectangle(canvas, (x1, y1), (x2, y2), color, 2)
                 cv2.putText(
-                    frame,
-                    f"ID:{track_id} {class_name}",
+                    canvas,
+                    f"ID:{track_id} {TARGET_CLASSES[cls]}",
                     (x1, y1 - 10),
                     cv2.FONT_HERSHEY_SIMPLEX,
                     0.5,
@@ -193,51 +537,42 @@ def process_video():
                     2
                 )
 
-        # Cleanup inactive tracks (prevents memory leak)
-        with state_lock:
-            for tid in list(track_history.keys()):
-                if tid not in active_ids:
-                    del track_history[tid]
-        total_cumulative = (
-            cumulative_counts["Car"]
-            + cumulative_counts["Bus"]
-            + cumulative_counts["Truck"]
-            + cumulative_counts["Person"]
-            + cumulative_counts["Bicycle"]
-        )
+    # Cleanup inactive tracks (prevents memory leak)
+    for tid in list(last_y):
+        if tid not in active_ids:
+            del last_y[tid]
 
-        # ---- ALERT LOGIC BASED ON TOTAL CUMULATIVE COUNT ----
-        if total_cumulative <= 10:
-            traffic_status = "LOW"
-            status_color = "green"
-            message = "Smooth Traffic Flow"
-        elif total_cumulative > 10 and total_cumulative <= 20:
-            traffic_status = "MEDIUM"
-            status_color = "orange"
-            message = "Moderate Traffic Volume"
-        else:
-            traffic_status = "HIGH"
-            status_color = "red"
-            message = "🚨 Heavy Traffic Volume"
+    if not emitting:
+        return
 
+    counts = {name: int(class_counts[i]) for i, name in enumerate(CLASS_NAMES)}
+    total_cumulative = int(total_counted[0])
 
-        # Encode and emit
-        _, buffer = cv2.imencode(".jpg", frame)
-        frame_base64 = base64.b64encode(buffer).decode("utf-8")
+    # ---- ALERT LOGIC BASED ON TOTAL CUMULATIVE COUNT ----
+    traffic_status, status_color, message = next(
+        (level, color, msg)
+        for bound, level, color, msg in STATUSES
+        if total_cumulative <= bound
+    )
 
-        socketio.emit(
-            "video_data",
+
+    # Hand off to the writer stage (snapshot the counts — the writer
+    # thread must not see them mid-update). If the writer is backed up,
+    # drop the frame rather than stall inference.
+    try:
+        write_q.put_nowait((
+            canvas,
+            counts,
             {
-                "image": frame_base64,
-                "counts": cumulative_counts,
-                "status": {
                 "level": traffic_status,
                 "color": status_color,
                 "message": message,
                 "density": total_cumulative
-                }
             }
-        )
+        ))
+        _last_emit = now
+    except queue.Full:
+        pass
 
 
 # -------------------------------------------------
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import io from 'socket.io-client';
 import { motion, AnimatePresence } from 'framer-motion';
 // ADDED: Imports for the Alert Icons
@@ -123,12 +123,21 @@ const TrafficDashboard = () => {
   const [selectedFile, setSelectedFile] = useState(null);
   const [uploadStatus, setUploadStatus] = useState('');
 
+  // Last object URL we handed to <img>, so each frame can revoke the
+  // previous one (kept in a ref — updater functions must stay pure)
+  const imageUrlRef = useRef(null);
+
   /* -------- SOCKET LISTENER -------- */
   useEffect(() => {
     const handler = (data) => {
-      setImage(`data:image/jpeg;base64,${data.image}`);
-      setCounts({ ...initialCounts, ...data.counts }); 
-      
+      // Backend sends raw JPEG bytes (binary attachment), not base64
+      const blob = new Blob([data.image], { type: 'image/jpeg' });
+      const url = URL.createObjectURL(blob);
+      if (imageUrlRef.current) URL.revokeObjectURL(imageUrlRef.current);
+      imageUrlRef.current = url;
+      setImage(url);
+      setCounts({ ...initialCounts, ...data.counts });
+
       // NEW: Update status if backend sends it
       if (data.status && data.status.level) {
         setStatus(data.status);
@@ -136,7 +145,13 @@ const TrafficDashboard = () => {
     };
 
     socket.on('video_data', handler);
-    return () => socket.off('video_data', handler);
+    return () => {
+      socket.off('video_data', handler);
+      if (imageUrlRef.current) {
+        URL.revokeObjectURL(imageUrlRef.current);
+        imageUrlRef.current = null;
+      }
+    };
   }, []);
 
   /* -------- UPLOAD HANDLER -------- */